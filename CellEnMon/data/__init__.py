@@ -71,11 +71,15 @@ class CustomDatasetDataLoader():
         dataset_class = find_dataset_using_name(opt.dataset_mode)
         self.dataset = dataset_class(opt)
         print("dataset [%s] was created" % type(self.dataset).__name__)
+        num_workers = int(opt.num_threads)
         self.dataloader = torch.utils.data.DataLoader(
             self.dataset,
             batch_size=opt.batch_size,
             shuffle=not opt.serial_batches,
-            num_workers=int(opt.num_threads))
+            num_workers=num_workers,
+            pin_memory=len(opt.gpu_ids) > 0,  # page-locked batches allow async host->device copies
+            persistent_workers=num_workers > 0,  # keep the workers alive between epochs
+            prefetch_factor=4 if num_workers > 0 else None)
 
     def load_data(self):
         return self
@@ -165,15 +165,21 @@ class BaseModel(ABC, nn.Module):
                 visual_ret[name] = getattr(self, name)
         return visual_ret
 
-    def get_current_losses(self,is_train):
-        """Return traning losses / errors. train.py will print out these errors on console, and save them to a file"""
-        errors_ret = OrderedDict()
+    def get_current_loss_tensor(self, is_train):
+        """Return the loss names and a 1-D tensor with their current values, without synchronizing with the GPU"""
         dataset_type_str="Train" if is_train else "Validation"
-
+        names = []
+        values = []
         for name in self.loss_names:
             if isinstance(name, str):
-                errors_ret[f'{dataset_type_str}/{name}'] = float(getattr(self, f'loss_{dataset_type_str}_' + name))  # float(...) works for both scalar tensor and float number
-        return errors_ret
+                names.append(f'{dataset_type_str}/{name}')
+                values.append(torch.as_tensor(getattr(self, f'loss_{dataset_type_str}_' + name), device=self.device).detach().float())  # works for both scalar tensor and float number
+        return names, torch.stack(values)
+
+    def get_current_losses(self,is_train):
+        """Return traning losses / errors. train.py will print out these errors on console, and save them to a file"""
+        names, values = self.get_current_loss_tensor(is_train)
+        return OrderedDict(zip(names, values.cpu().tolist()))  # a single device->host copy for all the losses
 
     def save_networks(self, epoch):
         """Save all the networks to the disk.
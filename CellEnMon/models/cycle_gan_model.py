@@ -1,12 +1,13 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import itertools
 from .base_model import BaseModel
 from CellEnMon.util.image_pool import SignalPool
+from CellEnMon.util.dpsgd import DecentralizedAverager
 from .networks import define_G, define_D, GANLoss
 import numpy as np
 import os
-import config
 
 threshold = float(os.environ["threshold"])
 rec_probability_threshold = float(os.environ["rec_probability_threshold"])
@@ -86,7 +87,8 @@ class CycleGANModel(BaseModel):
         # specify the training losses you want to print out. The training/test scripts will call <BaseModel.get_current_losses>
         self.loss_names = ['cycle_A', 'cycle_B', 'mse_A', 'mse_B','bce_rec_B', "idt_A", "idt_B" ] #
         
-        if int(os.environ["ENABLE_GAN"]):
+        self.enable_gan = bool(int(os.environ["ENABLE_GAN"]))  # read once, checked on every training step
+        if self.enable_gan:
             self.loss_names.append('D_A')
             self.loss_names.append('D_B')
             self.loss_names.append('G_A')
@@ -100,6 +102,13 @@ class CycleGANModel(BaseModel):
             visual_names_B.append('idt_A')
 
         self.visual_names = visual_names_A + visual_names_B  # combine visualizations for A and B
+        # resolve the input keys for opt.direction once, so <set_input> has no per-step branching on it
+        if opt.direction == 'AtoB':
+            self._key_A, self._key_B = 'A', 'B'
+            self._key_val_A, self._key_val_B = 'attenuation_sample', 'rain_rate_sample'
+        else:
+            self._key_A, self._key_B = 'B', 'A'
+            self._key_val_A, self._key_val_B = 'rain_rate_sample', 'attenuation_sample'
         # specify the models you want to save to the disk. The training/test scripts will call <BaseModel.save_networks> and <BaseModel.load_networks>.
         if self.isTrain:
             self.model_names = ['G_A', 'G_B', 'D_A', 'D_B']
@@ -110,9 +119,9 @@ class CycleGANModel(BaseModel):
         # The naming is different from those used in the paper.
         # Code (vs. paper): G_A (G), G_B (F), D_A (D_Y), D_B (D_X)
         self.netG_A = define_G(opt.input_nc_A, opt.output_nc_A, opt.ngf, opt.netG, opt.norm,
-                               not opt.no_dropout, opt.init_type, opt.init_gain, self.gpu_ids,direction="AtoB")
+                               not opt.no_dropout, opt.init_type, opt.init_gain, self.gpu_ids,direction="AtoB", grad_checkpoint=opt.grad_checkpoint)
         self.netG_B = define_G(opt.input_nc_B, opt.output_nc_B, opt.ngf, opt.netG, opt.norm,
-                               not opt.no_dropout, opt.init_type, opt.init_gain, self.gpu_ids, direction="BtoA")
+                               not opt.no_dropout, opt.init_type, opt.init_gain, self.gpu_ids, direction="BtoA", grad_checkpoint=opt.grad_checkpoint)
 
         if self.isTrain:  # define discriminators
             self.netD_A = define_D(opt.input_nc_A, opt.ndf, opt.netD,
@@ -120,6 +129,10 @@ class CycleGANModel(BaseModel):
             self.netD_B = define_D(opt.input_nc_B, opt.ndf, opt.netD,
                                    opt.n_layers_D, opt.norm, opt.init_type, opt.init_gain, self.gpu_ids)
 
+        if opt.compile:  # compile in-place so the state_dict keys (save/load) stay unchanged
+            for name in self.model_names:
+                getattr(self, 'net' + name).compile(mode="reduce-overhead", fullgraph=False)
+
         if self.isTrain:
             self.fake_A_pool = SignalPool(opt.pool_size)  # create signal buffer to store previously generated signals
             self.fake_B_pool = SignalPool(opt.pool_size)  # create signal buffer to store previously generated signals
@@ -129,12 +142,41 @@ class CycleGANModel(BaseModel):
             self.criterionIdt = torch.nn.L1Loss()
             self.mse = torch.nn.MSELoss()
             # initialize optimizers; schedulers will be automatically created by function <BaseModel.setup>.
+            # fused Adam updates all parameters in a few multi-tensor kernels instead of one launch per tensor
+            use_fused = self.device.type == 'cuda'
             self.optimizer_G = torch.optim.Adam(itertools.chain(self.netG_A.parameters(), self.netG_B.parameters()),
-                                                lr=opt.lr, betas=(opt.beta1, 0.999))
+                                                lr=opt.lr, betas=(opt.beta1, 0.999), fused=use_fused, capturable=opt.cuda_graph)
             self.optimizer_D = torch.optim.Adam(itertools.chain(self.netD_A.parameters(), self.netD_B.parameters()),
-                                                lr=opt.lr, betas=(opt.beta1, 0.999))
+                                                lr=opt.lr, betas=(opt.beta1, 0.999), fused=use_fused, capturable=opt.cuda_graph)
             self.optimizers.append(self.optimizer_G)
             self.optimizers.append(self.optimizer_D)
+            # loss scalers for mixed precision; both are no-ops unless --amp is set
+            self.scaler_G = torch.amp.GradScaler(self.device.type, enabled=opt.amp)
+            self.scaler_D = torch.amp.GradScaler(self.device.type, enabled=opt.amp)
+            self.accum_iter = 0  # number of micro-batches accumulated so far, see <optimize_parameters>
+            self.is_optimizer_step = False
+            if opt.cuda_graph:
+                if self.device.type != 'cuda' or opt.amp or opt.compile or opt.grad_checkpoint or opt.grad_accum_steps != 1:
+                    raise ValueError('--cuda_graph needs a GPU and cannot be combined with --amp, --compile, --grad_checkpoint or --grad_accum_steps > 1')
+                self.graph = None  # captured training step, see <graphed_run_step>
+                self.graph_key = None
+                self.graph_warmup = 0
+                self.graph_warmup_iters = 3
+                # tensors written by <run_step> that live in the graph's memory and are put back after each replay
+                self.graph_output_names = ['fake_A', 'fake_B', 'fake_B_det', 'rec_A', 'rec_B', 'rec_B_det',
+                                           'rec_B_det_without_activation', 'rec_B_mask', 'rec_B_dot_detection',
+                                           'loss_G'] + ['loss_' + name for name in self.loss_names]
+                if self.enable_gan:
+                    self.graph_output_names += ['D_A', 'D_B']
+            if opt.dpsgd:  # multi-GPU: average the weights with a random peer after every update
+                averaged_nets = [self.netG_A, self.netG_B]
+                if self.enable_gan:  # the discriminators are only trained with the GAN terms
+                    averaged_nets += [self.netD_A, self.netD_B]
+                self.averager = DecentralizedAverager(averaged_nets)
+
+    def autocast(self):
+        """Return the autocast context used for the forward passes and the losses (fp16 when --amp is set)"""
+        return torch.autocast(self.device.type, dtype=torch.float16, enabled=self.opt.amp)
 
     def weight_func(self, x, a):
         return 1/(a * torch.exp(-x*a))
@@ -147,30 +189,19 @@ class CycleGANModel(BaseModel):
 
         The option 'direction' can be used to swap domain A and domain B.
         """
-        AtoB = self.opt.direction == 'AtoB'
         self.slice_dist=input['slice_dist']
-        self.noise = torch.rand(self.slice_dist, device="cuda:0") * 0.1
-        self.real_A = input['A' if AtoB else 'B'].to(self.device) if isTrain else input["attenuation_sample" if AtoB else 'rain_rate_sample'].to(self.device)
-        self.real_B = input['B' if AtoB else 'A'].to(self.device) if isTrain else input['rain_rate_sample' if AtoB else 'attenuation_sample'].to(self.device)
+        self.real_A = input[self._key_A if isTrain else self._key_val_A].to(self.device, non_blocking=True)
+        self.real_B = input[self._key_B if isTrain else self._key_val_B].to(self.device, non_blocking=True)
         self.gague = input['gague']
         self.link = input['link']
         self.t = input['Time']
         self.dataset_type="Train" if isTrain else "Validation"
         self.isTrain=isTrain
-        self.rain_rate_prob = input['rain_rate_prob'].to(self.device)
-        L=input['distance'].to(self.device)
-        self.L=L+self.epsilon
-        self.dist_func=1/(torch.log(1+(self.L/config.TRAIN_RADIUS)))
+        self.rain_rate_prob = input['rain_rate_prob'].to(self.device, non_blocking=True)
         self.epoch=epoch
         
         
         if isTrain:
-            self.alpha=0.02
-            self.metadata_A = input['metadata_A' if AtoB else 'metadata_B'].to(self.device)
-            self.metadata_B = input['metadata_B' if AtoB else 'metadata_A'].to(self.device)
-            self.attenuation_prob = input['attenuation_prob'].to(self.device)
-
-            
             self.link_norm_metadata=input['link_norm_metadata']
             self.link_metadata=input['link_metadata']
             self.link_full_name=input['link_full_name'][0]
@@ -217,7 +248,7 @@ class CycleGANModel(BaseModel):
 
     def forward(self):
         """Run forward pass; called by both functions <optimize_parameters> and <test>."""          
-        activation = nn.ReLU() #nn.Identity() #nn.ReLU()
+        activation = F.relu #nn.Identity() #nn.ReLU()
         
         ##############
         ## >> Fake ###
@@ -233,14 +264,13 @@ class CycleGANModel(BaseModel):
 
             # >> B
         self.fake_B=activation(fake_B[0]) ## <<-- regression
-        self.fake_B_dot_detection = self.fake_B * (self.fake_B_det >= fake_probability_threshold)
 
         ############
         ## >> Rec ##
         ############
         rec_B=self.netG_A(self.fake_A,dir="AtoB")
 
-        self.rec_B_det_without_activation = rec_B[1]
+        self.rec_B_det_without_activation = rec_B[1] # logits, consumed by the fused sigmoid+BCE in <backward_G>
         self.rec_B_det = torch.sigmoid(rec_B[1]) ### <-- detection
             
         # >> A
@@ -249,7 +279,9 @@ class CycleGANModel(BaseModel):
         # >> B
             ## >> rec Detection
         self.rec_B = activation(rec_B[0]) ## <<-- regression
-        self.rec_B_dot_detection = self.rec_B * (self.rec_B_det >= rec_probability_threshold)
+        # the detection mask is cast once to the signal dtype so the gating is a single pointwise multiply
+        self.rec_B_mask = (self.rec_B_det >= rec_probability_threshold).to(self.rec_B.dtype)
+        self.rec_B_dot_detection = self.rec_B * self.rec_B_mask
 
 
     def backward_D_basic(self, netD, real, fake, weight=1): #weight=torch.ones([1], device='cuda:0')
@@ -263,19 +295,20 @@ class CycleGANModel(BaseModel):
         Return the discriminator loss.
         We also call loss_D.backward() to calculate the gradients.
         """
-        L2=nn.MSELoss(reduction='none')
-        # Real
-        pred_real = netD(real)
-        target = torch.full_like(pred_real, 1).to(pred_real.device)
-        loss_D_real = torch.mean(L2(pred_real, target))
-        # Fake
-        pred_fake = netD(fake.detach())
-        target = torch.full_like(pred_fake, 0).to(pred_fake.device)
-        loss_D_fake = torch.mean(L2(pred_fake, target))
-        # Combined loss and calculate gradients
-        loss_D = (loss_D_real + loss_D_fake)
+        L2=self.mse
+        with self.autocast():
+            # Real
+            pred_real = netD(real)
+            target = torch.ones_like(pred_real)
+            loss_D_real = L2(pred_real, target)
+            # Fake
+            pred_fake = netD(fake.detach())
+            target = torch.zeros_like(pred_fake)
+            loss_D_fake = L2(pred_fake, target)
+            # Combined loss and calculate gradients
+            loss_D = (loss_D_real + loss_D_fake)
         if self.isTrain:
-            loss_D.backward()
+            self.scaler_D.scale(loss_D / self.opt.grad_accum_steps).backward()
         return loss_D
 
     def backward_D_A(self):
@@ -312,110 +345,201 @@ class CycleGANModel(BaseModel):
             print(f"rec_B * rr_prob: {(self.rec_B * self.rain_rate_prob).shape}")
             assert(False)
 
-        lambda_A = 10
-        lambda_B = 10
-        # Identity loss
-        L1_idt=nn.L1Loss(reduction='none')
-        self.loss_idt_A = torch.sum(L1_idt(self.fake_A, self.real_A))
-        self.loss_idt_B = torch.sum(L1_idt(self.fake_B, self.real_B)) #* self.rain_rate_prob
+        with self.autocast():  # losses are computed under autocast, backward runs outside of it
+            # Identity loss
+            # reduce inside the loss kernel instead of materializing the elementwise loss first
+            self.loss_idt_A = F.l1_loss(self.fake_A, self.real_A, reduction='sum')
+            self.loss_idt_B = F.l1_loss(self.fake_B, self.real_B, reduction='sum') #* self.rain_rate_prob
 
-        rec_bce_weight_loss = nn.BCEWithLogitsLoss(weight=self.rain_rate_prob) #  
-        BCE = nn.BCELoss(weight=self.rain_rate_prob)
-
-        targets=(self.real_B >= threshold).float()
+            targets=(self.real_B >= threshold).float()
         
 
-        # BCE for detector
-        self.loss_bce_rec_B  = BCE(self.rec_B_det, targets)
+            # BCE for detector - sigmoid is fused into the loss, so we feed the logits
+            self.loss_bce_rec_B = F.binary_cross_entropy_with_logits(self.rec_B_det_without_activation, targets, weight=self.rain_rate_prob)
 
 
-        L1=nn.L1Loss(reduction='none')
-        L2=nn.MSELoss(reduction='none')
+            L2=self.mse
 
 
-        # Backward cycle loss
-        self.loss_cycle_A = torch.mean(L2(self.rec_A, self.real_A))
-        self.loss_cycle_B = 1000 * torch.mean(L2(self.rec_B_dot_detection, self.real_B)) #
+            # Backward cycle loss
+            self.loss_cycle_A = L2(self.rec_A, self.real_A)
+            self.loss_cycle_B = 1000 * L2(self.rec_B_dot_detection, self.real_B) #
 
-        # gamma=2        
-        # residual = torch.abs(self.rec_B - self.real_B)  # L1 loss
-        # modulating_factor = (1 - torch.exp(-residual)) ** gamma # Modulating factor
-        # self.loss_cycle_B = torch.mean(modulating_factor * self.rain_rate_prob * residual)
-        
+            # gamma=2
+            # residual = torch.abs(self.rec_B - self.real_B)  # L1 loss
+            # modulating_factor = (1 - torch.exp(-residual)) ** gamma # Modulating factor
+            # self.loss_cycle_B = torch.mean(modulating_factor * self.rain_rate_prob * residual)
         
-        # GAN loss D_B(G_A(A))
-        self.D_B=self.netD_B(self.fake_B) # self.fake_B_dot_detection
-        targets = torch.full_like(self.D_B, 1.0).to(self.D_B.device)
-        self.loss_G_B_only = torch.mean(L2(self.D_B, targets))
-
-        # GAN loss D_A(G_B(B))
-        self.D_A=self.netD_A(self.fake_A)
-        targets = torch.full_like(self.D_A, 1.0).to(self.D_A.device)
-        self.loss_G_A = torch.mean(L2(self.D_A, targets)) #weight=self.rr_norm.max(), weight=self.att_norm.mean()
         
-
-
-        self.loss_mse_A = torch.mean(L2(self.fake_A, self.real_A))
-        self.loss_mse_B = torch.mean(L2(self.fake_B, self.real_B))
-
-        self.loss_G = \
-            (     
-                self.loss_cycle_A +\
-                self.loss_cycle_B +\
-
-                self.loss_bce_rec_B
-            )
-
-        GAN_LOSS=0
-        if int(os.environ["ENABLE_GAN"]):
-            ## >> As per original paper, cycle loss needs to be x10 the loss of the GAN
-            GAN_LOSS =\
-            (
-                self.loss_G_B_only +\
-                self.loss_G_A
-            )
-
-        self.loss_G = self.loss_G + GAN_LOSS
+            self.loss_mse_A = L2(self.fake_A, self.real_A)
+            self.loss_mse_B = L2(self.fake_B, self.real_B)
+
+            self.loss_G = \
+                (
+                    self.loss_cycle_A +\
+                    self.loss_cycle_B +\
+
+                    self.loss_bce_rec_B
+                )
+
+            GAN_LOSS=0
+            if self.enable_gan:
+                # Discriminator passes are only needed for the GAN terms, skip them otherwise
+                # GAN loss D_B(G_A(A))
+                self.D_B=self.netD_B(self.fake_B) # self.fake_B_dot_detection
+                targets = torch.ones_like(self.D_B)
+                self.loss_G_B_only = L2(self.D_B, targets)
+
+                # GAN loss D_A(G_B(B))
+                self.D_A=self.netD_A(self.fake_A)
+                targets = torch.ones_like(self.D_A)
+                self.loss_G_A = L2(self.D_A, targets) #weight=self.rr_norm.max(), weight=self.att_norm.mean()
+
+                ## >> As per original paper, cycle loss needs to be x10 the loss of the GAN
+                GAN_LOSS =\
+                (
+                    self.loss_G_B_only +\
+                    self.loss_G_A
+                )
+
+            self.loss_G = self.loss_G + GAN_LOSS
 
         if self.isTrain:
-            self.loss_G.backward()
+            self.scaler_G.scale(self.loss_G / self.opt.grad_accum_steps).backward()
 
    
     
+    def warmup(self, input, epoch, n_iters=3):
+        """Run forward and backward passes without updating the weights.
+
+        Parameters:
+            input (dict) -- a training batch, see <set_input>
+            epoch (int)  -- current epoch
+            n_iters (int) -- number of warmup iterations
+
+        With --compile the first calls trigger compilation and CUDA graph recording,
+        so we run them here before the timed training loop.
+        """
+        for _ in range(n_iters):
+            self.set_input(input, epoch)
+            with self.autocast():
+                self.forward()
+            self.set_requires_grad([self.netD_A, self.netD_B], False)
+            self.backward_G()
+            if self.enable_gan:
+                self.set_requires_grad([self.netD_A, self.netD_B], True)
+                self.backward_D_A()
+                self.backward_D_B()
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none=True)
+
     def min_max_inv_transform(self,x, mmin, mmax):
         return x # x * (mmax - mmin) + mmin
     
-    def optimize_parameters(self, is_train=True):
-        """Calculate losses, gradients, and update network weights; called in every training iteration"""
-        
-        dataset_type_str="Train" if is_train else "Validation"
-        self.forward()  # compute fake images and reconstruction images.
+    def run_step(self, is_first_micro_step=False):
+        """Run the forward pass, the G and D backward passes and (on training) the weight updates.
+
+        Parameters:
+            is_first_micro_step (bool) -- if the gradients are reset before the backward passes
+
+        This is the part of <optimize_parameters> that --cuda_graph captures and replays.
+        """
+        with self.autocast():
+            self.forward()  # compute fake images and reconstruction images.
         # G_A and G_B
         
         
         self.set_requires_grad([self.netD_A, self.netD_B], False)  # Ds require no gradients when optimizing Gs
-        self.optimizer_G.zero_grad()  # set G_A and G_B's gradients to zero
+        if self.isTrain and is_first_micro_step:
+            self.optimizer_G.zero_grad(set_to_none=True)  # set G_A and G_B's gradients to zero
         self.backward_G()  # calculate gradients for G_A and G_B
-        if self.isTrain:
-            self.optimizer_G.step()  # update G_A and G_B's weights
+        if self.isTrain and self.is_optimizer_step:
+            self.scaler_G.step(self.optimizer_G)  # update G_A and G_B's weights
+            self.scaler_G.update()
         
         # # D_A and D_B
         # ## resetting attrs ['D_A', 'G_A', 'cycle_A', 'D_B', 'G_B', 'cycle_B', 'mse_A', 'mse_B', 'bce_B','G_B_only']
 
 
-        if int(os.environ["ENABLE_GAN"]):
+        if self.enable_gan:
             self.set_requires_grad([self.netD_A, self.netD_B], True)
-            self.optimizer_D.zero_grad()  # set D_A and D_B's gradients to zero        
+            if self.isTrain and is_first_micro_step:
+                self.optimizer_D.zero_grad(set_to_none=True)  # set D_A and D_B's gradients to zero
             self.backward_D_A()  # calculate gradients for D_A
             self.backward_D_B()  # calculate graidents for D_B
-            if self.isTrain:
-                self.optimizer_D.step()  # update D_A and D_B's weights
-            
+            if self.isTrain and self.is_optimizer_step:
+                self.scaler_D.step(self.optimizer_D)  # update D_A and D_B's weights
+                self.scaler_D.update()
+
+    def graphed_run_step(self):
+        """Run <run_step> through a captured CUDA graph.
+
+        The first <graph_warmup_iters> steps run eagerly (on a side stream, as required before capture),
+        then the step is captured once and replayed: new batches are copied into the static input tensors
+        and the captured outputs listed in <graph_output_names> are put back on the model after each replay.
+        The graph is captured again when the input shapes or the learning rates change.
+        """
+        key = (self.real_A.shape, self.real_B.shape, self.rain_rate_prob.shape,
+               tuple(group['lr'] for optimizer in self.optimizers for group in optimizer.param_groups))
+        if self.graph is not None and key != self.graph_key:  # fallback: drop the graph, capture a new one
+            self.graph = None
+            if key[:3] != self.graph_key[:3]:
+                self.graph_warmup = 0
+
+        if self.graph is None and self.graph_warmup < self.graph_warmup_iters:
+            self.graph_warmup += 1
+            side_stream = torch.cuda.Stream()
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream):
+                self.run_step(is_first_micro_step=True)
+            torch.cuda.current_stream().wait_stream(side_stream)
+            return
+
+        if self.graph is None:
+            self.graph_inputs = {name: getattr(self, name).clone() for name in ['real_A', 'real_B', 'rain_rate_prob']}
+            self.__dict__.update(self.graph_inputs)
+            # grads are None here, so the captured backward allocates them from the graph's memory pool
+            self.optimizer_G.zero_grad(set_to_none=True)
+            self.optimizer_D.zero_grad(set_to_none=True)
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph):
+                self.run_step(is_first_micro_step=True)
+            self.graph_outputs = {name: getattr(self, name) for name in self.graph_output_names}
+            self.graph_key = key
+        else:
+            for name, static in self.graph_inputs.items():
+                static.copy_(getattr(self, name), non_blocking=True)
+            self.__dict__.update(self.graph_inputs)
+        self.graph.replay()
+        self.__dict__.update(self.graph_outputs)
+
+    def optimize_parameters(self, is_train=True):
+        """Calculate losses, gradients, and update network weights; called in every training iteration
+
+        Gradients are accumulated over <opt.grad_accum_steps> calls, the weights are only
+        updated (and the gradients reset) once per accumulation cycle.
+        """
+
+        dataset_type_str="Train" if is_train else "Validation"
+        is_first_micro_step = False
+        if self.isTrain:
+            is_first_micro_step = self.accum_iter % self.opt.grad_accum_steps == 0
+            self.accum_iter += 1
+            self.is_optimizer_step = self.accum_iter % self.opt.grad_accum_steps == 0
+        if self.isTrain and self.opt.cuda_graph:
+            self.graphed_run_step()
+        else:
+            self.run_step(is_first_micro_step)
+
+        if self.enable_gan:
             setattr(self,f"loss_{self.dataset_type}_G_B_only",self.loss_G_B_only)
             setattr(self,f"loss_{self.dataset_type}_D_A",self.loss_D_A)
             setattr(self,f"loss_{self.dataset_type}_G_A",self.loss_G_A)
             setattr(self,f"loss_{self.dataset_type}_D_B",self.loss_D_B)
 
+        if self.isTrain and self.is_optimizer_step and self.opt.dpsgd:
+            self.averager.step()
+
         setattr(self,f"loss_{self.dataset_type}_cycle_A",self.loss_cycle_A)
         setattr(self,f"loss_{self.dataset_type}_cycle_B",self.loss_cycle_B)
         setattr(self,f"loss_{self.dataset_type}_mse_A",self.loss_mse_A)
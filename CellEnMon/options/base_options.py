@@ -53,6 +53,9 @@ class BaseOptions():
         parser.add_argument('--init_gain', type=float, default=0.02,
                             help='scaling factor for normal, xavier and orthogonal.')
         parser.add_argument('--no_dropout', action='store_true', help='no dropout for the generator')
+        parser.add_argument('--compile', action='store_true', help='compile the networks with torch.compile (mode=reduce-overhead)')
+        parser.add_argument('--amp', action='store_true', help='train with automatic mixed precision (fp16 autocast + GradScaler)')
+        parser.add_argument('--grad_checkpoint', action='store_true', help='recompute the generator Resnet blocks in backward instead of storing their activations')
         # dataset parameters
         
         
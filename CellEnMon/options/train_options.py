@@ -35,6 +35,10 @@ class TrainOptions(BaseOptions):
         parser.add_argument('--pool_size', type=int, default=50, help='the size of image buffer that stores previously generated images')
         parser.add_argument('--lr_policy', type=str, default='linear', help='learning rate policy. [linear | step | plateau | cosine]')
         parser.add_argument('--lr_decay_iters', type=int, default=100000, help='multiply by a gamma every lr_decay_iters iterations')
+        parser.add_argument('--grad_accum_steps', type=int, default=1, help='number of batches to accumulate gradients over before each optimizer step')
+        parser.add_argument('--cuda_graph', action='store_true', help='capture the training step in a CUDA graph after a few warmup iterations and replay it')
+        parser.add_argument('--dpsgd', action='store_true', help='multi-GPU training with decentralized parallel SGD, launch with torchrun --nproc_per_node=N')
+        parser.add_argument('--dist_timeout', type=int, default=180, help='[dpsgd] process group timeout in minutes; must be longer than a validation pass, which only rank 0 runs')
 
         self.isTrain = True
         return parser
@@ -2,6 +2,7 @@ import math
 import os.path
 import time
 import torch
+import torch.distributed as dist
 import pandas as pd
 import glob
 from options.train_options import TrainOptions
@@ -13,7 +14,7 @@ from pathlib import Path
 import matplotlib
 matplotlib.use('Agg')  # Use the non-interactive backend 'Agg'
 import matplotlib.pyplot as plt
-from datetime import datetime
+from datetime import datetime, timedelta
 import matplotlib.dates as mpl_dates
 import config
 import torch.nn.functional as F
@@ -27,7 +28,6 @@ from sklearn.metrics import confusion_matrix
 from sklearn.metrics import ConfusionMatrixDisplay
 import numpy as np
 from matplotlib import colors
-from collections import defaultdict
 import warnings
 
 # Ignore a specific type of warning from a specific module
@@ -36,6 +36,11 @@ warnings.filterwarnings("ignore", message="'linear' x-axis tick spacing not even
 # Alternatively, ignore all warnings from a specific module
 warnings.filterwarnings("ignore", module="plotly.matplotlylib")
 
+# Allow TF32 tensor cores for fp32 matmuls/convs on Ampere+ (cudnn.benchmark is enabled in BaseModel)
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
+
 ENABLE_WANDB = bool(os.environ["ENABLE_WANDB"])
 GROUPS = {
     "DEBUG": {0: "DEBUG"},
@@ -159,10 +164,18 @@ if __name__ == '__main__':
     datetime_format='%Y-%m-%d %H:%M:%S' if config.export_type=="israel" else '%d-%m-%Y %H:%M' # no seconds required
     train_opt = TrainOptions().parse()  # get training options
     validation_opt = TestOptions().parse()
+    if train_opt.dpsgd:  # launched with torchrun: one process per GPU
+        local_rank = int(os.environ["LOCAL_RANK"])
+        dist.init_process_group("nccl", timeout=timedelta(minutes=train_opt.dist_timeout))
+        torch.cuda.set_device(local_rank)
+        train_opt.gpu_ids = [local_rank]
+        # every rank draws its own random CML-Gauge pairs, so each one runs 1/N of the epoch
+        train_opt.max_dataset_size = min(train_opt.max_dataset_size, NUMBER_OF_CML_GAUGE_RANDOM_SELECTIONS_IN_EACH_EPOCH // dist.get_world_size())
+    is_main_process = not train_opt.dpsgd or dist.get_rank() == 0  # only rank 0 logs and validates
     experiment_name = "only_dynamic" if train_opt.is_only_dynamic else "dynamic_and_static"
     v = Visualizer(experiment_name=experiment_name)
     print("Visualizer Initialized!")
-    if ENABLE_WANDB:
+    if ENABLE_WANDB and is_main_process:
         wandb.init(project=train_opt.name, entity='sagitiminsky',
                    group=f"exp_{SELECTED_GROUP_NAME}", job_type=GROUPS[SELECTED_GROUP_NAME][SELECT_JOB])
     print(f'💪Train💪')
@@ -182,11 +195,13 @@ if __name__ == '__main__':
 
     model = models.create_model(train_opt)  # create a model given opt.model and other options
     model.setup(train_opt)  # regular setup: load and print networks; create schedulers
+    if train_opt.compile:  # compile + record CUDA graphs before timing any iteration
+        model.warmup(next(iter(train_dataset)), epoch=0)
     total_iters = 0  # the total number of training iterations
     
     
     for epoch in range(train_opt.n_epochs + train_opt.n_epochs_decay):
-        training_losses=defaultdict(float)
+        training_loss_sum = None  # summed on the device, copied to the host only when it is logged
 #         direction = "AtoB" if (epoch // 10) % 2 == 0 else "BtoA"
         epoch_start_time = time.time()  # timer for entire epoch
         iter_data_time = time.time()  # timer for data loading per iteration
@@ -200,12 +215,13 @@ if __name__ == '__main__':
             if total_iters % train_opt.print_freq == 0:
                 t_data = iter_start_time - iter_data_time
 
-            total_iters += train_opt.batch_size
             epoch_iter += train_opt.batch_size
             
             #model.train()
             model.set_input(data, epoch)  # unpack data from dataset and apply preprocessing
             model.optimize_parameters(is_train=True)  # calculate loss functions, get gradients, update network weights
+            if model.is_optimizer_step:  # total_iters only advances on actual weight updates
+                total_iters += train_opt.batch_size * train_opt.grad_accum_steps
             
             # Training losses
             
@@ -214,16 +230,15 @@ if __name__ == '__main__':
 
             iter_data_time = time.time()
         
-            current_losses=model.get_current_losses(is_train=True)
-            for key in current_losses:
-                training_losses[key] += current_losses[key]
+            loss_names, current_losses = model.get_current_loss_tensor(is_train=True)
+            training_loss_sum = current_losses if training_loss_sum is None else training_loss_sum + current_losses
         
 
 
             
             
             
-        if epoch % ITERS_BETWEEN_VALIDATIONS == 0 and epoch>0: # VALIDATION
+        if epoch % ITERS_BETWEEN_VALIDATIONS == 0 and epoch>0 and is_main_process: # VALIDATION
 
             print(f'End of training epoch:{epoch} | Remember! in each epoch we trained on {NUMBER_OF_CML_GAUGE_RANDOM_SELECTIONS_IN_EACH_EPOCH} randomly selected CML-Gauge Pairs')
             print(f"Validation in progress...")
@@ -522,13 +537,16 @@ if __name__ == '__main__':
 
                 
             if ENABLE_WANDB:
-                for key in current_losses:
-                    training_losses[key] = training_losses[key]/(ITERS_BETWEEN_VALIDATIONS*len(train_dataset))
+                training_losses = OrderedDict(zip(loss_names, (training_loss_sum / (ITERS_BETWEEN_VALIDATIONS*len(train_dataset))).cpu().tolist()))
             
                 wandb.log({**training_losses})
                 path_to_html = f"{v.out_path}/{v.map_name}"
 #                 v.draw_cml_map()
 #                 wandb.log({"html": wandb.Html(open(path_to_html), inject=False)})
             print(print(f"Validation cycle end..."))
+        if train_opt.dpsgd:  # the other ranks wait here for rank 0 to finish validating before peer averaging resumes
+            dist.barrier()
 
-    # model.save_networks("latest")
\ No newline at end of file
+    # model.save_networks("latest")
+    if train_opt.dpsgd:
+        dist.destroy_process_group()
\ No newline at end of file
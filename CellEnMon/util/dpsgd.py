@@ -0,0 +1,55 @@
+import random
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+class DecentralizedAverager():
+    """This class implements the parameter averaging step of Decentralized Parallel SGD (DPSGD).
+
+    Every process trains its own replica on its own batches. After each optimizer step,
+    a replica averages its weights with a single peer on the ring instead of all-reducing
+    gradients across all processes. This fits CycleGAN's interleaved G / D updates,
+    which do not map onto a single DistributedDataParallel backward.
+    """
+
+    def __init__(self, nets, seed=0):
+        """Initialize the DecentralizedAverager class
+
+        Parameters:
+            nets (network list) -- the networks whose weights are averaged
+            seed (int)          -- seed for picking peers; must be the same on every process
+
+        The process group has to be initialized before (see train.py).
+        All the replicas start from the weights of rank 0.
+        """
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.rng = random.Random(seed)  # same sequence on all ranks, so peers agree on the offset
+        self.tensors = []
+        for net in nets:
+            self.tensors += [p.data for p in net.parameters()]
+            self.tensors += [b for b in net.buffers() if torch.is_floating_point(b)]
+        for tensor in self.tensors:
+            dist.broadcast(tensor, src=0)
+
+    @torch.no_grad()
+    def step(self):
+        """Average the weights with a random peer on the ring.
+
+        At each step all the ranks draw the same offset k, send their weights to rank+k
+        and receive the weights of rank-k, so every replica mixes with exactly one peer.
+        """
+        if self.world_size < 2:
+            return
+        offset = self.rng.randint(1, self.world_size - 1)
+        send_to = (self.rank + offset) % self.world_size
+        recv_from = (self.rank - offset) % self.world_size
+
+        flat = _flatten_dense_tensors(self.tensors)  # one message instead of one per tensor
+        peer = torch.empty_like(flat)
+        ops = [dist.P2POp(dist.isend, flat, send_to), dist.P2POp(dist.irecv, peer, recv_from)]
+        for request in dist.batch_isend_irecv(ops):
+            request.wait()
+        flat.add_(peer).mul_(0.5)
+        torch._foreach_copy_(self.tensors, _unflatten_dense_tensors(flat, self.tensors))  # multi-tensor copy back
@@ -1,4 +1,3 @@
-import random
 import torch
 
 
@@ -14,11 +13,13 @@ class SignalPool():
 
         Parameters:
             pool_size (int) -- the size of signal buffer, if pool_size=0, no buffer will be created
+
+        The buffer is a single preallocated tensor on the signals' device; it is allocated on the first <query>.
         """
         self.pool_size = pool_size
         if self.pool_size > 0:  # create an empty pool
             self.num_imgs = 0
-            self.signals = []
+            self.signals = None
 
     def query(self, signals):
         """Return an signal from the pool.
@@ -31,24 +32,27 @@ class SignalPool():
         By 50/100, the buffer will return input signals.
         By 50/100, the buffer will return signals previously stored in the buffer,
         and insert the current signals to the buffer.
+        The whole batch is handled with tensor ops on the signals' device, there is no per-signal Python loop.
         """
         if self.pool_size == 0:  # if the buffer size is 0, do nothing
             return signals
-        return_signals = []
-        for signal in signals:
-            signal = torch.unsqueeze(signal.data, 0)
-            if self.num_imgs < self.pool_size:   # if the buffer is not full; keep inserting current signals to the buffer
-                self.num_imgs = self.num_imgs + 1
-                self.signals.append(signal)
-                return_signals.append(signal)
-            else:
-                p = random.uniform(0, 1)
-                if p > 0.5:  # by 50% chance, the buffer will return a previously stored signal, and insert the current signal into the buffer
-                    random_id = random.randint(0, self.pool_size - 1)  # randint is inclusive
-                    tmp = self.signals[random_id].clone()
-                    self.signals[random_id] = signal
-                    return_signals.append(tmp)
-                else:       # by another 50% chance, the buffer will return the current signal
-                    return_signals.append(signal)
-        return_signals = torch.cat(return_signals, 0)   # collect all the signals and return
+        signals = signals.detach()
+        if self.signals is None:
+            self.signals = torch.empty((self.pool_size, *signals.shape[1:]), dtype=signals.dtype, device=signals.device)
+
+        # if the buffer is not full; keep inserting current signals to the buffer
+        n_insert = min(self.pool_size - self.num_imgs, signals.shape[0])
+        self.signals[self.num_imgs:self.num_imgs + n_insert] = signals[:n_insert]
+        self.num_imgs = self.num_imgs + n_insert
+        rest = signals[n_insert:]
+        if rest.shape[0] == 0:
+            return signals
+
+        # by 50% chance, the buffer will return a previously stored signal, and insert the current signal into the buffer
+        swap = torch.rand(rest.shape[0], device=rest.device) > 0.5
+        random_ids = torch.randint(0, self.pool_size, (rest.shape[0],), device=rest.device)
+        stored = self.signals[random_ids]  # advanced indexing gathers a copy, taken before the buffer is updated
+        self.signals[random_ids[swap]] = rest[swap]
+        swap = swap.view(-1, *([1] * (rest.dim() - 1)))
+        return_signals = torch.cat([signals[:n_insert], torch.where(swap, stored, rest)], 0)   # collect all the signals and return
         return return_signals
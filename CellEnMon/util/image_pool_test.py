@@ -0,0 +1,63 @@
+import unittest
+import torch
+from CellEnMon.util.image_pool import SignalPool
+
+
+def make_signals(values, length=8):
+    """Return a batch [len(values), 1, length] where signal i is constant values[i]"""
+    return torch.tensor(values, dtype=torch.float32).view(-1, 1, 1).expand(-1, 1, length).clone()
+
+
+class SignalPoolTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def assertRowsFrom(self, signals, allowed):
+        for signal in signals:
+            self.assertTrue(any(torch.equal(signal, candidate) for candidate in allowed))
+
+    def test_no_pool_returns_input(self):
+        pool = SignalPool(0)
+        signals = make_signals([1, 2, 3])
+        self.assertIs(pool.query(signals), signals)
+
+    def test_fill_returns_input(self):
+        pool = SignalPool(5)
+        signals = make_signals([1, 2, 3])
+        returned = pool.query(signals)
+        self.assertEqual(returned.shape, signals.shape)
+        self.assertTrue(torch.equal(returned, signals))
+        self.assertEqual(pool.num_imgs, 3)
+
+    def test_batch_straddles_pool_size(self):
+        pool = SignalPool(5)
+        first = make_signals([1, 2, 3])
+        pool.query(first)
+        second = make_signals([4, 5, 6, 7])
+        returned = pool.query(second)
+
+        self.assertEqual(returned.shape, second.shape)
+        self.assertEqual(pool.num_imgs, 5)
+        # the first two signals fill the pool and are returned as they are
+        self.assertTrue(torch.equal(returned[:2], second[:2]))
+        # the rest are either the input signal or one stored before this part of the batch
+        for i in range(2, 4):
+            self.assertRowsFrom(returned[i:i + 1], [second[i]] + list(first) + list(second[:2]))
+
+    def test_full_pool_returns_input_or_stored(self):
+        pool = SignalPool(4)
+        seen = []
+        for step in range(20):
+            signals = make_signals([10 * step + i for i in range(3)])
+            stored_before = list(pool.signals[:pool.num_imgs].clone()) if pool.signals is not None else []
+            returned = pool.query(signals)
+            self.assertEqual(returned.shape, signals.shape)
+            for i in range(signals.shape[0]):
+                self.assertRowsFrom(returned[i:i + 1], [signals[i]] + stored_before + list(signals[:i]))
+            seen += list(signals)
+            # the buffer only ever holds signals that were queried before
+            self.assertRowsFrom(pool.signals[:pool.num_imgs], seen)
+
+
+if __name__ == '__main__':
+    unittest.main()